@@ -10,15 +10,33 @@ Tuya Multi-Sensor → Prometheus Pushgateway Exporter
 - Опциональная работа через SOCKS5 прокси
 """
 from tuya_connector import TuyaOpenAPI
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway
+from prometheus_client.exposition import default_handler
+from prometheus_client.core import GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
+import requests
 import time
 import logging
 import json
 import os
 import yaml
 import socket
+import random
+import threading
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# orjson (опционально) заметно быстрее разбирает большие devices.json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Устанавливаем глобальный таймаут для всех socket операций (30 секунд)
 socket.setdefaulttimeout(30.0)
@@ -32,6 +50,23 @@ ACCESS_KEY = os.getenv("TUYA_ACCESS_KEY")
 API_ENDPOINT = os.getenv("TUYA_API_ENDPOINT", "https://openapi.tuyaeu.com")
 PUSHGATEWAY = os.getenv("PUSHGATEWAY_URL")
 INTERVAL = int(os.getenv("INTERVAL", "60"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+
+# Максимум device_ids в одном запросе /v1.0/iot-03/devices/status
+BULK_STATUS_LIMIT = 20
+
+# Endpoint-ы для поштучного запроса устройства (для некоторых категорий работает только второй)
+DEVICE_INFO_ENDPOINT = "/v1.0/devices/{}"
+DEVICE_STATUS_ENDPOINT = "/v1.0/iot-03/devices/{}/status"
+
+# Токен Tuya обновляется в фоне за 5 минут до истечения, повтор при ошибке - через 30-60 секунд
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_DELAY = 30
+# Минимальный остаток жизни токена перед раздачей запросов потокам (секунды)
+TOKEN_MIN_VALIDITY = 60
+
+# При неудачных циклах подряд пауза растёт экспоненциально, но не больше 5 * INTERVAL
+BACKOFF_MAX_MULTIPLIER = 5
 
 # SOCKS5 Proxy configuration (optional)
 PROXY_HOST = os.getenv("PROXY_HOST")
@@ -42,6 +77,11 @@ PROXY_PASSWORD = os.getenv("PROXY_PASSWORD")
 # === LOGGING ===
 os.makedirs("logs", exist_ok=True)
 
+# Форматы логов не используют поток/процесс - не собираем эти поля в каждой записи
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 # Configure logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -49,7 +89,7 @@ logger.setLevel(logging.INFO)
 # Console handler
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
-console_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+console_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 console_handler.setFormatter(console_formatter)
 
 # File handler (rotating, max 10MB, keep 5 backups)
@@ -60,92 +100,151 @@ file_handler = RotatingFileHandler(
     encoding='utf-8'
 )
 file_handler.setLevel(logging.INFO)
-file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 file_handler.setFormatter(file_formatter)
 
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# Запись в консоль и файл (включая ротацию) выполняется в фоновом потоке QueueListener,
+# цикл опроса только кладёт записи в очередь
+log_queue = queue.Queue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # === SETUP SOCKS5 PROXY ===
-if PROXY_HOST and PROXY_USER and PROXY_PASSWORD:
-    import socks
-    import socket
-
-    socks.set_default_proxy(
-        socks.SOCKS5,
-        PROXY_HOST,
-        PROXY_PORT,
-        rdns=True,  # Enable remote DNS resolution through SOCKS5
-        username=PROXY_USER,
-        password=PROXY_PASSWORD
-    )
-    socket.socket = socks.socksocket
-    logger.info(f"🔒 SOCKS5 proxy enabled: {PROXY_HOST}:{PROXY_PORT} (remote DNS)")
-else:
-    logger.info("📡 Using direct connection (no proxy)")
+# Прокси задаётся HTTP-сессиям экспортера (Tuya API и Pushgateway), а не глобально для всех сокетов процесса
+PROXIES = {}
+_proxy_initialized = False
+
+pushgateway_session = requests.Session()
+
+def setup_proxy():
+    """Настраиваем SOCKS5 прокси для HTTP-сессий (один раз за процесс)"""
+    global _proxy_initialized
+    if _proxy_initialized:
+        return
+    _proxy_initialized = True
+
+    if not (PROXY_HOST and PROXY_USER and PROXY_PASSWORD):
+        logger.info("📡 Using direct connection (no proxy)")
+        return
+
+    # socks5h - DNS резолвится через прокси (remote DNS)
+    proxy_url = f"socks5h://{quote(PROXY_USER, safe='')}:{quote(PROXY_PASSWORD, safe='')}@{PROXY_HOST}:{PROXY_PORT}"
+    PROXIES.update({"http": proxy_url, "https": proxy_url})
+    openapi.session.proxies.update(PROXIES)
+    pushgateway_session.proxies.update(PROXIES)
+    logger.info("🔒 SOCKS5 proxy enabled: %s:%s (remote DNS)", PROXY_HOST, PROXY_PORT)
+
+def pushgateway_handler(url, method, timeout, headers, data):
+    """Отправляем метрики в Pushgateway через requests-сессию с прокси"""
+    def handle():
+        response = pushgateway_session.request(method, url, data=data, headers=dict(headers), timeout=timeout)
+        response.raise_for_status()
+    return handle
 
 # === INIT TUYA API ===
+# Подключение (получение токена) выполняется в main() после настройки прокси
 openapi = TuyaOpenAPI(API_ENDPOINT, ACCESS_ID, ACCESS_KEY)
-openapi.connect()
+
+# Обновление токена и опрос устройств не выполняются одновременно
+token_lock = threading.Lock()
+
+def refresh_token():
+    """Получаем новый токен Tuya API, при ошибке оставляем прежний"""
+    with token_lock:
+        previous_token = openapi.token_info
+        # Запрос /v1.0/token подписывается без access_token
+        openapi.token_info = None
+        try:
+            response = openapi.connect()
+        except Exception as e:
+            response = {"msg": str(e)}
+
+        if openapi.is_connect():
+            logger.info("🔑 Tuya API token refreshed")
+            return True
+
+        openapi.token_info = previous_token
+        logger.error("❌ Tuya API token refresh failed: %s", (response or {}).get("msg"))
+        return False
+
+def ensure_token():
+    """Обновляем токен в основном потоке, если его нет или он скоро истечёт"""
+    # Иначе SDK обновит токен неявно сразу в нескольких потоках пула
+    token_info = openapi.token_info
+    if token_info and token_info.expire_time / 1000 - time.time() > TOKEN_MIN_VALIDITY:
+        return True
+    return refresh_token()
+
+def token_refresh_loop():
+    """Фоновый поток: обновляем токен заранее, чтобы цикл опроса не ждал его обновления"""
+    while True:
+        token_info = openapi.token_info
+        delay = token_info.expire_time / 1000 - time.time() - TOKEN_REFRESH_MARGIN if token_info else 0
+        time.sleep(max(delay, TOKEN_RETRY_DELAY))
+
+        while not refresh_token():
+            time.sleep(random.uniform(TOKEN_RETRY_DELAY, TOKEN_RETRY_DELAY * 2))
+
+def configure_http_pool(device_count):
+    """Настраиваем пул keep-alive соединений для запросов к Tuya API"""
+    # TuyaOpenAPI уже держит один requests.Session - расширяем его пул под количество устройств,
+    # чтобы TCP+TLS соединения переиспользовались между циклами опроса
+    pool_size = max(8, device_count * 2)
+    # Обрывы соединения (частые через прокси) повторяем сразу, а не ждём следующего цикла
+    retries = Retry(total=3, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=retries)
+    openapi.session.mount("https://", adapter)
+    openapi.session.headers["Connection"] = "keep-alive"
+    logger.info("🔗 HTTP connection pool: up to %s keep-alive connection(s)", pool_size)
 
 # === METRICS (with labels) ===
 registry = CollectorRegistry()
-humidity_gauge = Gauge(
-    'tuya_plant_humidity',
-    'Soil humidity (%)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-temperature_gauge = Gauge(
-    'tuya_plant_temperature',
-    'Soil temperature (°C)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-battery_gauge = Gauge(
-    'tuya_plant_battery',
-    'Battery level (%)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-humidity_threshold_min_gauge = Gauge(
-    'tuya_plant_humidity_threshold_min',
-    'Minimum optimal soil humidity (%)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-humidity_threshold_max_gauge = Gauge(
-    'tuya_plant_humidity_threshold_max',
-    'Maximum optimal soil humidity (%)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
+
+# Labels всех метрик устройств
+DEVICE_LABELS = ['device_id', 'device_name', 'group']
+
+class DeviceMetricsCollector:
+    """Отдаёт последние значения устройств готовыми GaugeMetricFamily при каждом push"""
+
+    def __init__(self, metrics):
+        # Ключ значения -> (имя метрики, описание)
+        self.metrics = metrics
+        # device_id -> (labels, {ключ значения: число}); основной цикл пишет сюда одним присваиванием на устройство
+        self.latest = {}
+
+    def collect(self):
+        families = {
+            key: GaugeMetricFamily(name, documentation, labels=DEVICE_LABELS)
+            for key, (name, documentation) in self.metrics.items()
+        }
+        for labels, values in self.latest.values():
+            for key, value in values.items():
+                families[key].add_metric(labels, value)
+        return families.values()
+
+soil_collector = DeviceMetricsCollector({
+    'humidity': ('tuya_plant_humidity', 'Soil humidity (%)'),
+    'temperature': ('tuya_plant_temperature', 'Soil temperature (°C)'),
+    'battery': ('tuya_plant_battery', 'Battery level (%)'),
+})
+threshold_collector = DeviceMetricsCollector({
+    'humidity_min': ('tuya_plant_humidity_threshold_min', 'Minimum optimal soil humidity (%)'),
+    'humidity_max': ('tuya_plant_humidity_threshold_max', 'Maximum optimal soil humidity (%)'),
+})
 
 # === SMART PLUG METRICS ===
-plug_switch_gauge = Gauge(
-    'tuya_plug_switch',
-    'Smart plug switch state (0=off, 1=on)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-plug_power_gauge = Gauge(
-    'tuya_plug_power',
-    'Current power consumption (W)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-plug_current_gauge = Gauge(
-    'tuya_plug_current',
-    'Current draw (mA)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
-plug_voltage_gauge = Gauge(
-    'tuya_plug_voltage',
-    'Voltage (V)',
-    ['device_id', 'device_name', 'group'],
-    registry=registry
-)
+plug_collector = DeviceMetricsCollector({
+    'switch': ('tuya_plug_switch', 'Smart plug switch state (0=off, 1=on)'),
+    'power': ('tuya_plug_power', 'Current power consumption (W)'),
+    'current': ('tuya_plug_current', 'Current draw (mA)'),
+    'voltage': ('tuya_plug_voltage', 'Voltage (V)'),
+})
+
+registry.register(soil_collector)
+registry.register(threshold_collector)
+registry.register(plug_collector)
 
 heartbeat_gauge = Gauge(
     'tuya_exporter_last_success_timestamp',
@@ -153,83 +252,104 @@ heartbeat_gauge = Gauge(
     registry=registry
 )
 
+# DP-коды, которые экспортируются в метрики (остальные коды из ответа API не сохраняем)
+SOIL_SENSOR_CODES = frozenset({"humidity", "temp_current", "battery_percentage"})
+SMART_PLUG_CODES = frozenset({"switch_1", "cur_power", "cur_current", "cur_voltage"})
+METRIC_CODES = SOIL_SENSOR_CODES | SMART_PLUG_CODES
+
+# Категории Tuya: zwjcy - датчики почвы, cz - умные розетки
+SOIL_CATEGORIES = frozenset({"zwjcy"})
+PLUG_CATEGORIES = frozenset({"cz"})
+# Датчики почвы без категории zwjcy определяем по названию продукта
+SOIL_PRODUCT_KEYWORDS = ("Soil", "Plant")
+
+def is_soil_sensor(dev):
+    """Датчик почвы: категория zwjcy или ключевое слово в названии продукта"""
+    if dev.get("category") in SOIL_CATEGORIES:
+        return True
+    product_name = dev.get("product_name", "")
+    return any(keyword in product_name for keyword in SOIL_PRODUCT_KEYWORDS)
+
+def is_smart_plug(dev):
+    """Умная розетка: категория cz"""
+    return dev.get("category") in PLUG_CATEGORIES
+
 def get_all_devices():
     """Загружаем устройства из devices.json (TinyTuya wizard output)"""
     try:
-        if not os.path.exists("devices.json"):
-            logger.error("❌ devices.json not found!")
-            logger.info("💡 Run 'python wizard.py' first to discover devices")
-            return []
-
-        with open("devices.json", "r", encoding="utf-8") as f:
-            devices = json.load(f)
+        with open("devices.json", "rb") as f:
+            devices = json_loads(f.read())
 
         if not isinstance(devices, list):
             logger.error("❌ Invalid devices.json format")
             return []
 
-        logger.info(f"📄 Loaded {len(devices)} devices from devices.json")
-
-        # Фильтруем датчики почвы (zwjcy) и розетки (cz)
-        filtered_devices = []
-
-        for dev in devices:
-            category = dev.get("category", "")
-            product_name = dev.get("product_name", "")
-            name = dev.get("name", "Unknown")
-
-            # Определяем датчики почвы по категории или названию продукта
-            is_soil_sensor = category == "zwjcy" or "Soil" in product_name or "Plant" in product_name
-            # Определяем розетки по категории
-            is_smart_plug = category == "cz"
-
-            if is_soil_sensor or is_smart_plug:
-                filtered_devices.append({
-                    "id": dev["id"],
-                    "name": name,
-                    "category": category,
-                    "online": True,  # Считаем все устройства из devices.json активными
-                    "product_name": product_name
-                })
+        logger.info("📄 Loaded %s devices from devices.json", len(devices))
+
+        # Фильтруем датчики почвы (zwjcy или по названию продукта) и розетки (cz)
+        filtered_devices = [
+            {
+                "id": dev["id"],
+                "name": dev.get("name", "Unknown"),
+                "category": dev.get("category", ""),
+                "online": True,  # Считаем все устройства из devices.json активными
+                "product_name": dev.get("product_name", "")
+            }
+            for dev in devices
+            if is_soil_sensor(dev) or is_smart_plug(dev)
+        ]
 
         # Подсчитываем устройства по типам
         soil_count = sum(1 for d in filtered_devices if d['category'] == 'zwjcy')
         plug_count = sum(1 for d in filtered_devices if d['category'] == 'cz')
 
-        logger.info(f"Found {soil_count} soil sensor(s) and {plug_count} smart plug(s):")
+        logger.info("Found %s soil sensor(s) and %s smart plug(s):", soil_count, plug_count)
         for device in filtered_devices:
             device_type = "sensor" if device['category'] == 'zwjcy' else "plug"
-            logger.info(f"  - [{device_type}] {device['name']} ({device['id']})")
+            logger.info("  - [%s] %s (%s)", device_type, device['name'], device['id'])
 
         return filtered_devices
 
+    except FileNotFoundError:
+        logger.error("❌ devices.json not found!")
+        logger.info("💡 Run 'python wizard.py' first to discover devices")
+        return []
     except Exception as e:
-        logger.error(f"Error loading devices.json: {e}", exc_info=True)
+        logger.error("Error loading devices.json: %s", e, exc_info=True)
         return []
 
+# Быстрый C-загрузчик libyaml, если PyYAML собран с ним
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Дефолтные значения если конфиг не найден
+# (один и тот же объект, чтобы main() не считал конфиг изменившимся каждый цикл)
+DEFAULT_PLANT_CONFIG = {
+    'defaults': {
+        'humidity_min': 40,
+        'humidity_max': 60
+    },
+    'plants': {}
+}
+
+# Последний разобранный plant_config.yaml и его mtime
+_plant_config_cache = {"mtime": None, "data": None}
+
 def load_plant_config():
-    """Загружаем конфигурацию пороговых значений для растений из YAML"""
+    """Загружаем конфигурацию пороговых значений для растений из YAML (перечитываем только при изменении файла)"""
     config_path = "plant_config.yaml"
-
-    # Дефолтные значения если конфиг не найден
-    default_config = {
-        'defaults': {
-            'humidity_min': 40,
-            'humidity_max': 60
-        },
-        'plants': {}
-    }
+    default_config = DEFAULT_PLANT_CONFIG
 
     try:
-        if not os.path.exists(config_path):
-            logger.debug(f"📝 {config_path} not found, using defaults")
-            return default_config
+        # os.stat одновременно проверяет наличие файла и даёт mtime
+        mtime = os.stat(config_path).st_mtime_ns
+        if mtime == _plant_config_cache["mtime"]:
+            return _plant_config_cache["data"]
 
         with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YAML_LOADER)
 
         if not config:
-            logger.warning(f"⚠️  {config_path} is empty, using defaults")
+            logger.warning("⚠️  %s is empty, using defaults", config_path)
             return default_config
 
         # Проверяем структуру конфига
@@ -238,87 +358,173 @@ def load_plant_config():
         if 'plants' not in config:
             config['plants'] = {}
 
-        logger.debug(f"✅ Loaded plant config: {len(config['plants'])} custom settings")
+        _plant_config_cache["mtime"] = mtime
+        _plant_config_cache["data"] = config
+
+        logger.debug("✅ Loaded plant config: %s custom settings", len(config['plants']))
         return config
 
+    except FileNotFoundError:
+        logger.debug("📝 %s not found, using defaults", config_path)
+        return default_config
     except yaml.YAMLError as e:
-        logger.error(f"❌ Error parsing {config_path}: {e}")
+        logger.error("❌ Error parsing %s: %s", config_path, e)
         return default_config
     except Exception as e:
-        logger.error(f"❌ Error loading {config_path}: {e}")
+        logger.error("❌ Error loading %s: %s", config_path, e)
         return default_config
 
-def get_device_data(device_id):
-    """Получаем данные конкретного устройства"""
-    try:
-        response = openapi.get(f"/v1.0/devices/{device_id}")
+def parse_status(status):
+    """Собираем {code: value} за один проход, только для экспортируемых DP-кодов"""
+    return {item["code"]: item["value"] for item in status if item["code"] in METRIC_CODES}
 
-        if not response.get("success"):
-            logger.debug(f"Device info failed, trying status endpoint...")
-            response = openapi.get(f"/v1.0/iot-03/devices/{device_id}/status")
+def parse_device_info(result):
+    """Разбираем ответ /v1.0/devices/{id} - объект устройства со списком status"""
+    return parse_status((result or {}).get("status", []))
 
-        if not response.get("success"):
-            logger.error(f"API error for {device_id}: {response.get('code')} - {response.get('msg')}")
-            return None
+def parse_status_list(result):
+    """Разбираем ответ /v1.0/iot-03/devices/{id}/status - сразу список status"""
+    return parse_status(result or [])
 
-        result = response.get("result", {})
+# Каждый endpoint всегда возвращает один и тот же формат ответа
+DEVICE_ENDPOINTS = {
+    DEVICE_INFO_ENDPOINT: parse_device_info,
+    DEVICE_STATUS_ENDPOINT: parse_status_list,
+}
 
-        # Обрабатываем разные форматы ответа
-        if isinstance(result, list):
-            status = result
+def get_device_data(device):
+    """Получаем данные конкретного устройства"""
+    device_id = device["id"]
+    try:
+        # Сначала пробуем endpoint, который сработал для устройства в прошлый раз
+        preferred = device.get("_endpoint", DEVICE_INFO_ENDPOINT)
+        for endpoint in sorted(DEVICE_ENDPOINTS, key=lambda e: e != preferred):
+            response = openapi.get(endpoint.format(device_id))
+            if response.get("success"):
+                device["_endpoint"] = endpoint
+                break
+            logger.debug("%s failed for %s, trying next endpoint...", endpoint, device_id)
         else:
-            status = result.get("status", [])
-
-        if not status:
+            logger.error("API error for %s: %s - %s", device_id, response.get('code'), response.get('msg'))
             return None
 
-        data_dict = {item["code"]: item["value"] for item in status}
-        return data_dict
+        data = DEVICE_ENDPOINTS[endpoint](response.get("result"))
+        return data or None
 
     except socket.timeout:
-        logger.error(f"Timeout при получении данных для {device_id}")
+        logger.error("Timeout при получении данных для %s", device_id)
         return None
     except ConnectionError as e:
-        logger.error(f"Ошибка соединения при получении данных для {device_id}: {e}")
+        logger.error("Ошибка соединения при получении данных для %s: %s", device_id, e)
         return None
     except Exception as e:
-        logger.error(f"Ошибка при получении данных для {device_id}: {e}")
+        logger.error("Ошибка при получении данных для %s: %s", device_id, e)
         return None
 
-def push_metrics(device_id, device_name, group, data):
+def get_devices_status_bulk(device_ids):
+    """Получаем статус нескольких устройств одним запросом (не более BULK_STATUS_LIMIT)"""
+    try:
+        response = openapi.get("/v1.0/iot-03/devices/status", {"device_ids": ",".join(device_ids)})
+
+        if not response.get("success"):
+            logger.warning("Bulk status API error: %s - %s", response.get('code'), response.get('msg'))
+            return {}
+
+        return {
+            item["id"]: parse_status(item.get("status", []))
+            for item in response.get("result", [])
+        }
+
+    except socket.timeout:
+        logger.error("Timeout при пакетном получении данных для %s устройств", len(device_ids))
+        return {}
+    except ConnectionError as e:
+        logger.error("Ошибка соединения при пакетном получении данных: %s", e)
+        return {}
+    except Exception as e:
+        logger.error("Ошибка при пакетном получении данных: %s", e)
+        return {}
+
+def fetch_all_device_data(devices, executor):
+    """Получаем данные всех устройств пакетными запросами (параллельно, не более MAX_WORKERS одновременно)"""
+    devices_by_id = {device["id"]: device for device in devices}
+    device_ids = list(devices_by_id)
+    batches = [device_ids[i:i + BULK_STATUS_LIMIT] for i in range(0, len(device_ids), BULK_STATUS_LIMIT)]
+
+    device_data = {}
+    batch_futures = {executor.submit(get_devices_status_bulk, batch): batch for batch in batches}
+    fallback_futures = {}
+
+    for future in as_completed(batch_futures):
+        batch_data = future.result()
+        device_data.update(batch_data)
+
+        # Устройства, не вернувшиеся в пакетном ответе, сразу запрашиваем по одному
+        missing_ids = [device_id for device_id in batch_futures[future] if device_id not in batch_data]
+        if missing_ids:
+            logger.debug("Bulk status missing %s device(s), requesting individually", len(missing_ids))
+            for device_id in missing_ids:
+                fallback_futures[executor.submit(get_device_data, devices_by_id[device_id])] = device_id
+
+    for future in as_completed(fallback_futures):
+        device_data[fallback_futures[future]] = future.result()
+
+    return device_data
+
+def get_device_group(device, plant_config):
+    """Определяем группу освещения устройства по plant_config.yaml"""
+    if device["category"] == "zwjcy":
+        plant_settings = plant_config['plants'].get(device["name"], {})
+        return plant_settings.get('group', plant_config['defaults'].get('group', 'unknown'))
+
+    plug_settings = plant_config.get('plugs', {}).get(device["name"], {})
+    return plug_settings.get('group', 'unknown')
+
+def push_metrics(device, group, data):
     """Отправляем метрики с labels"""
+    # Устройство не прислало ни одного кода датчика почвы
+    if SOIL_SENSOR_CODES.isdisjoint(data):
+        return False
+
+    device_name = device["name"]
+    values = {}
     try:
-        metrics_pushed = False
+        readings = []
 
         # Влажность почвы
         if "humidity" in data:
             humidity = float(data["humidity"])
-            humidity_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(humidity)
-            logger.info(f"  💧 {device_name}: Humidity {humidity}%")
-            metrics_pushed = True
+            values["humidity"] = humidity
+            readings.append(f"💧 Humidity {humidity}%")
 
         # Температура
         if "temp_current" in data:
             temp = float(data["temp_current"]) / 10
-            temperature_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(temp)
-            logger.info(f"  🌡️  {device_name}: Temperature {temp}°C")
-            metrics_pushed = True
+            values["temperature"] = temp
+            readings.append(f"🌡️  Temperature {temp}°C")
 
         # Батарея
         if "battery_percentage" in data:
             battery = float(data["battery_percentage"])
-            battery_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(battery)
-            logger.info(f"  🔋 {device_name}: Battery {battery}%")
-            metrics_pushed = True
+            values["battery"] = battery
+            readings.append(f"🔋 Battery {battery}%")
+
+        if values:
+            soil_collector.latest[device["id"]] = ((device["id"], device_name, group), values)
 
-        return metrics_pushed
+        # Одна строка лога на устройство вместо отдельной строки на каждое показание
+        if readings:
+            logger.info("  🌱 %s: %s", device_name, ', '.join(readings))
+
+        return bool(readings)
 
     except Exception as e:
-        logger.error(f"Error processing metrics for {device_name}: {e}")
+        logger.error("Error processing metrics for %s: %s", device_name, e)
         return False
 
-def push_thresholds(device_id, device_name, group, plant_config):
+def push_thresholds(device, group, plant_config):
     """Устанавливаем пороговые значения влажности для растения"""
+    device_name = device["name"]
     try:
         # Ищем настройки для конкретного растения по имени
         plant_settings = plant_config['plants'].get(device_name)
@@ -332,54 +538,64 @@ def push_thresholds(device_id, device_name, group, plant_config):
             humidity_max = plant_config['defaults']['humidity_max']
 
         # Устанавливаем метрики
-        humidity_threshold_min_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(humidity_min)
-        humidity_threshold_max_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(humidity_max)
+        threshold_collector.latest[device["id"]] = (
+            (device["id"], device_name, group),
+            {'humidity_min': float(humidity_min), 'humidity_max': float(humidity_max)}
+        )
 
-        logger.debug(f"  📊 {device_name}: Thresholds {humidity_min}-{humidity_max}%")
+        logger.debug("  📊 %s: Thresholds %s-%s%%", device_name, humidity_min, humidity_max)
         return True
 
     except Exception as e:
-        logger.error(f"Error setting thresholds for {device_name}: {e}")
+        logger.error("Error setting thresholds for %s: %s", device_name, e)
         return False
 
-def push_plug_metrics(device_id, device_name, group, data):
+def push_plug_metrics(device, group, data):
     """Отправляем метрики для розетки"""
+    # Устройство не прислало ни одного кода розетки
+    if SMART_PLUG_CODES.isdisjoint(data):
+        return False
+
+    device_name = device["name"]
+    values = {}
     try:
-        metrics_pushed = False
+        readings = []
 
         # Состояние вкл/выкл
         if "switch_1" in data:
             switch_state = 1 if data["switch_1"] else 0
-            plug_switch_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(switch_state)
+            values["switch"] = switch_state
             state_text = "ON" if switch_state else "OFF"
-            logger.info(f"  🔌 {device_name}: Switch {state_text}")
-            metrics_pushed = True
+            readings.append(f"Switch {state_text}")
 
         # Мощность
         if "cur_power" in data:
             power = float(data["cur_power"]) / 10  # Конвертируем в ватты
-            plug_power_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(power)
-            logger.info(f"  ⚡ {device_name}: Power {power}W")
-            metrics_pushed = True
+            values["power"] = power
+            readings.append(f"⚡ Power {power}W")
 
         # Ток
         if "cur_current" in data:
             current = float(data["cur_current"])
-            plug_current_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(current)
-            logger.info(f"  🔋 {device_name}: Current {current}mA")
-            metrics_pushed = True
+            values["current"] = current
+            readings.append(f"Current {current}mA")
 
         # Напряжение
         if "cur_voltage" in data:
             voltage = float(data["cur_voltage"]) / 10  # Конвертируем в вольты
-            plug_voltage_gauge.labels(device_id=device_id, device_name=device_name, group=group).set(voltage)
-            logger.info(f"  ⚡ {device_name}: Voltage {voltage}V")
-            metrics_pushed = True
+            values["voltage"] = voltage
+            readings.append(f"Voltage {voltage}V")
+
+        if values:
+            plug_collector.latest[device["id"]] = ((device["id"], device_name, group), values)
 
-        return metrics_pushed
+        if readings:
+            logger.info("  🔌 %s: %s", device_name, ', '.join(readings))
+
+        return bool(readings)
 
     except Exception as e:
-        logger.error(f"Error processing plug metrics for {device_name}: {e}")
+        logger.error("Error processing plug metrics for %s: %s", device_name, e)
         return False
 
 def main():
@@ -395,62 +611,104 @@ def main():
         logger.info("\n💡 Run 'python wizard.py' to discover your devices\n")
         return
 
-    logger.info(f"\n📊 Starting monitoring of {len(devices)} device(s)...\n")
+    # Статус online задаётся при загрузке devices.json и не меняется - разделяем устройства один раз
+    online_devices = [d for d in devices if d["online"]]
+    for device in devices:
+        if not device["online"]:
+            logger.warning("⚠️  %s is offline, skipping...", device['name'])
+
+    setup_proxy()
+    configure_http_pool(len(devices))
+
+    try:
+        openapi.connect()
+    except Exception as e:
+        logger.error("❌ Tuya API connection failed: %s", e)
+    if not openapi.is_connect():
+        logger.warning("⚠️  No Tuya API token yet, retrying in background")
+
+    threading.Thread(target=token_refresh_loop, name="token-refresh", daemon=True).start()
+
+    # Один пул потоков на всё время работы, потоки переиспользуются между циклами
+    executor = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(devices)), thread_name_prefix="tuya-fetch")
+
+    logger.info("\n📊 Starting monitoring of %s device(s)...\n", len(online_devices))
+
+    # Конфиг, пороги из которого уже выставлены в метрики
+    applied_plant_config = None
+
+    # Циклы запускаются по монотонному расписанию, чтобы время опроса не сдвигало период
+    next_deadline = time.monotonic()
+    consecutive_failures = 0
 
     while True:
+        # Цикл считается неудачным, пока не собраны данные хотя бы одного устройства
+        cycle_failed = True
+
         try:
-            # Загружаем конфиг пороговых значений (перечитывается каждый цикл для автообновления)
+            # Загружаем конфиг пороговых значений (перечитывается при изменении файла для автообновления)
             plant_config = load_plant_config()
 
+            # Пороги и группы меняются только вместе с конфигом - выставляем их один раз на каждую его версию
+            if plant_config is not applied_plant_config:
+                threshold_collector.latest.clear()
+                for device in online_devices:
+                    if device["category"] == "zwjcy":
+                        push_thresholds(device, get_device_group(device, plant_config), plant_config)
+                applied_plant_config = plant_config
+
             any_data = False
 
-            for device in devices:
+            # Показания собираются заново каждый цикл - не ответившие устройства не попадут в push
+            soil_collector.latest.clear()
+            plug_collector.latest.clear()
+
+            # Запросы к Tuya API выполняются пакетами и параллельно, обработка результатов - последовательно
+            ensure_token()
+            with token_lock:
+                device_data = fetch_all_device_data(online_devices, executor)
+
+            for device in online_devices:
                 device_id = device["id"]
-                device_name = device["name"]
                 device_category = device.get("category", "")
 
-                if not device["online"]:
-                    logger.warning(f"⚠️  {device_name} is offline, skipping...")
-                    continue
-
-                data = get_device_data(device_id)
+                data = device_data.get(device_id)
 
                 if not data:
                     continue
 
                 # Обрабатываем датчики почвы
                 if device_category == "zwjcy":
-                    # Извлекаем group из конфигурации растения
-                    plant_settings = plant_config['plants'].get(device_name, {})
-                    group = plant_settings.get('group', plant_config['defaults'].get('group', 'unknown'))
-
-                    # Устанавливаем пороговые значения для растения
-                    push_thresholds(device_id, device_name, group, plant_config)
-
-                    if push_metrics(device_id, device_name, group, data):
+                    if push_metrics(device, get_device_group(device, plant_config), data):
                         any_data = True
 
                 # Обрабатываем розетки
                 elif device_category == "cz":
-                    # Извлекаем group из конфигурации розетки
-                    plug_settings = plant_config.get('plugs', {}).get(device_name, {})
-                    group = plug_settings.get('group', 'unknown')
-
-                    if push_plug_metrics(device_id, device_name, group, data):
+                    if push_plug_metrics(device, get_device_group(device, plant_config), data):
                         any_data = True
 
             if any_data:
+                cycle_failed = False
+
                 # Update heartbeat timestamp on successful data collection
                 try:
-                    heartbeat_gauge.set(time.time())
-                    push_to_gateway(PUSHGATEWAY, job='tuya_sensors', registry=registry, grouping_key={'instance': 'home'}, timeout=10)
-                    logger.info(f"✅ All metrics pushed to Pushgateway (heartbeat updated)\n")
+                    heartbeat_gauge.set_to_current_time()
+                    # POST заменяет только присланные метрики группы, а не всю группу целиком
+                    pushadd_to_gateway(
+                        PUSHGATEWAY,
+                        job='tuya_sensors',
+                        registry=registry,
+                        grouping_key={'instance': 'home'},
+                        timeout=10,
+                        handler=pushgateway_handler if PROXIES else default_handler
+                    )
+                    logger.info("✅ All metrics pushed to Pushgateway (heartbeat updated)\n")
                 except socket.timeout:
                     logger.error("❌ Timeout при отправке метрик в Pushgateway\n")
                 except ConnectionError as e:
-                    logger.error(f"❌ Ошибка соединения с Pushgateway: {e}\n")
+                    logger.error("❌ Ошибка соединения с Pushgateway: %s\n", e)
                 except Exception as e:
-                    logger.error(f"❌ Ошибка при отправке метрик в Pushgateway: {e}\n")
+                    logger.error("❌ Ошибка при отправке метрик в Pushgateway: %s\n", e)
             else:
                 logger.warning("⚠️  No data collected in this cycle\n")
 
@@ -458,11 +716,27 @@ def main():
             logger.info("\n👋 Stopped by user")
             break
         except Exception as e:
-            logger.error(f"❌ Unexpected error in main loop: {e}\n", exc_info=True)
-            logger.info("Продолжаем работу через 60 секунд...\n")
-            time.sleep(60)
-
-        time.sleep(INTERVAL)
+            logger.error("❌ Unexpected error in main loop: %s\n", e, exc_info=True)
+
+        if cycle_failed:
+            # Не долбим Tuya API каждый INTERVAL, пока он недоступен; джиттер разносит повторы во времени
+            consecutive_failures += 1
+            backoff = INTERVAL * min(2 ** consecutive_failures, BACKOFF_MAX_MULTIPLIER) + random.uniform(0, INTERVAL)
+            logger.info("⏳ %s failed cycle(s) in a row, retrying in %.0fs\n", consecutive_failures, backoff)
+            time.sleep(backoff)
+            next_deadline = time.monotonic()
+            continue
+
+        consecutive_failures = 0
+        next_deadline += INTERVAL
+        sleep_for = next_deadline - time.monotonic()
+        if sleep_for < 0:
+            logger.warning("⚠️  Cycle took %.1fs longer than INTERVAL (%ss), starting next cycle now", -sleep_for, INTERVAL)
+            next_deadline = time.monotonic()
+            sleep_for = 0
+        time.sleep(sleep_for)
+
+    executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     main()